@@ -1,76 +1,382 @@
+import asyncio
 import chainlit as cl
+import httpx
 from openai import AsyncAzureOpenAI
 import json
+import logging
 import os
+import re
+import time
+from collections import deque
+from typing import Any, Optional, Union
 from dotenv import load_dotenv
 
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    orjson = None
+    ORJSON_AVAILABLE = False
+
+try:
+    from pydantic import ConfigDict, TypeAdapter, ValidationError, create_model
+    PYDANTIC_AVAILABLE = True
+except ImportError:
+    ConfigDict = TypeAdapter = create_model = None
+    ValidationError = ValueError
+    PYDANTIC_AVAILABLE = False
+
+try:
+    import sqlglot
+    SQLGLOT_AVAILABLE = True
+except ImportError:
+    sqlglot = None
+    SQLGLOT_AVAILABLE = False
+
+try:
+    import h2  # noqa: F401  (httpx needs it for HTTP/2)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+load_dotenv()
+
+logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+log_level_name = os.environ.get("LOG_LEVEL", "INFO").strip().upper()
+# getLevelName returns the numeric level for known names and a "Level x" string otherwise.
+if isinstance(logging.getLevelName(log_level_name), int):
+    logger.setLevel(log_level_name)
+else:
+    logger.setLevel(logging.INFO)
+    logger.warning("Unknown LOG_LEVEL %r; falling back to INFO.", log_level_name)
+
 try:
     from mcp import ClientSession
     MCP_CLASSES_AVAILABLE = True
-    print("DEBUG: Successfully imported ClientSession from 'mcp'")
+    logger.debug("Successfully imported ClientSession from 'mcp'")
 except ImportError:
     ClientSession = None 
     MCP_CLASSES_AVAILABLE = False
-    print("DEBUG: Warning: Could not import ClientSession from 'mcp'.")
-    print("DEBUG: Please ensure your Chainlit environment provides this, or check for 'mcp-sdk' installation if it's a separate requirement.")
-
+    logger.warning("Could not import ClientSession from 'mcp'.")
+    logger.warning("Please ensure your Chainlit environment provides this, or check for 'mcp-sdk' installation if it's a separate requirement.")
 
-load_dotenv()
 
 azure_api_key = os.environ.get("AZURE_OPENAI_API_KEY")
 azure_endpoint = os.environ.get("AZURE_OPENAI_ENDPOINT")
 azure_api_version = os.environ.get("AZURE_OPENAI_API_VERSION")
 azure_deployment_name = os.environ.get("AZURE_OPENAI_DEPLOYMENT_NAME", "gpt-4o")
 postgres_connection_string = os.environ.get("POSTGRESQL_CONNECTION_STRING")
+# Read with the same name and default as the MCP server (src/postgres/index.ts) so both sides agree.
+try:
+    pg_statement_timeout_ms = int(os.environ.get("PG_STATEMENT_TIMEOUT_MS") or 30000)
+except ValueError:
+    pg_statement_timeout_ms = 30000
+if pg_statement_timeout_ms <= 0:
+    pg_statement_timeout_ms = 30000
 
 
 if not all([azure_api_key, azure_endpoint, azure_api_version, azure_deployment_name]):
-    print("DEBUG: Warning: Azure OpenAI environment variables are not fully set.")
+    logger.warning("Azure OpenAI environment variables are not fully set.")
     azure_client = None
 else:
+    # One shared pool for all chat sessions; the default httpx limits throttle concurrent users.
+    azure_http_client = httpx.AsyncClient(
+       http2=HTTP2_AVAILABLE,
+       limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+       timeout=httpx.Timeout(60.0, connect=5.0),
+    )
     azure_client = AsyncAzureOpenAI(
        api_key=azure_api_key,
        azure_endpoint=azure_endpoint,
-       api_version=azure_api_version
+       api_version=azure_api_version,
+       http_client=azure_http_client,
+       max_retries=2,
     )
-    print(f"DEBUG: Azure OpenAI client initialized for deployment: {azure_deployment_name}, endpoint: {azure_endpoint}")
+    logger.debug("Azure OpenAI client initialized for deployment: %s, endpoint: %s", azure_deployment_name, azure_endpoint)
 
 
 POSTGRES_MCP_SERVER_NAME = "postgres"
+SYSTEM_PROMPT = "You are a helpful assistant that can query a PostgreSQL database. When you need to query the database, use the tool provided by the 'postgres' MCP server. The SQL should be valid PostgreSQL."
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+# History keeps only user messages and final assistant answers; tool calls and their (possibly large)
+# results live for one turn only, so they are not re-sent on every later completion.
+MAX_HISTORY_MESSAGES = 20
+MAX_TOOL_ROUNDS = 5
+STREAM_FLUSH_INTERVAL_SECONDS = 0.015
+STREAM_FLUSH_MAX_CHARS = 64
+# The server's statement_timeout cancels the query first; the grace lets its error reach the LLM
+# instead of a bare client-side timeout.
+MCP_TOOL_TIMEOUT_SECONDS = pg_statement_timeout_ms / 1000 + 5.0
+SQL_QUERY_TOOL_NAME = "query"
+TOOL_CACHE_TTL_SECONDS = 60.0
+TOOL_CACHE_MAX_ENTRIES = 256
+
+
+def _json_loads(data):
+    # orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers can catch either way.
+    if ORJSON_AVAILABLE:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj):
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+
+def _json_dumps_indented(obj):
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(obj, indent=2)
+
+
+def _json_dumps_sorted(obj):
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS, default=str).decode()
+    return json.dumps(obj, sort_keys=True, default=str)
+
+
+_JSON_SCHEMA_TYPES = {"string": str, "integer": int, "number": int | float, "boolean": bool, "array": list, "object": dict}
+
+
+def _schema_type(prop_schema):
+    """Map a property subschema to a Python type; anything not expressible becomes Any."""
+    if not isinstance(prop_schema, dict):
+        return Any  # Boolean subschemas (true/false) and other non-dict forms.
+    json_type = prop_schema.get("type")
+    if isinstance(json_type, str):
+        return _JSON_SCHEMA_TYPES.get(json_type, Any)
+    if isinstance(json_type, list) and json_type and all(isinstance(t, str) for t in json_type):
+        # A type union such as ["integer", "null"].
+        if any(t not in _JSON_SCHEMA_TYPES and t != "null" for t in json_type):
+            return Any
+        members = tuple(type(None) if t == "null" else _JSON_SCHEMA_TYPES[t] for t in json_type)
+        return Union[members] if len(members) > 1 else members[0]
+    return Any
+
+
+def _build_tool_adapter(input_schema):
+    """Build a strict TypeAdapter that validates a tool's arguments against its inputSchema, if expressible."""
+    if not PYDANTIC_AVAILABLE:
+        return None
+    try:
+        if not isinstance(input_schema, dict) or input_schema.get("type") != "object":
+            return None
+        required = set(input_schema.get("required") or ())
+        fields = {}
+        for prop_name, prop_schema in (input_schema.get("properties") or {}).items():
+            if not prop_name.isidentifier() or prop_name.startswith("_"):
+                return None
+            prop_type = _schema_type(prop_schema)
+            fields[prop_name] = (prop_type, ...) if prop_name in required else (Optional[prop_type], None)
+        model = create_model("ToolArguments", __config__=ConfigDict(extra="allow", strict=True), **fields)
+        return TypeAdapter(model)
+    except Exception as e:
+        # Skip validation for this tool only; the tool itself must still be registered.
+        logger.debug("Could not build argument model from schema %s: %s", input_schema, e)
+        return None
+
+
+def _parse_tool_args(adapter, tool_arguments_str):
+    return _validate_tool_args(adapter, _json_loads(tool_arguments_str))
+
+
+def _validate_tool_args(adapter, tool_args):
+    # Validation only rejects bad arguments; the dict the LLM sent is what reaches MCP and the cache key.
+    if adapter is not None:
+        adapter.validate_python(tool_args)
+    return tool_args
+
+
+def _tool_msg(tool_call_id, name, content):
+    return {"tool_call_id": tool_call_id, "role": "tool", "name": name, "content": content}
+
+
+# String literals, quoted identifiers, dollar-quoted bodies and comments are kept verbatim; only
+# whitespace between them is collapsed. A line comment keeps its newline so it cannot swallow later text.
+_SQL_WS_OR_VERBATIM = re.compile(
+    r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|\$([A-Za-z_]*)\$.*?\$\2\$|--[^\n]*\n?|/\*.*?\*/)|\s+",
+    re.DOTALL,
+)
+
+
+def _canonicalize_sql(sql):
+    # Backslash escapes (E'...' strings) can hide a quote from the literal-matching regex, so such queries
+    # are keyed on their raw text rather than risk two different queries sharing a key.
+    if "\\" in sql or "E'" in sql or "e'" in sql:
+        return sql
+    if SQLGLOT_AVAILABLE:
+        try:
+            statements = sqlglot.parse(sql, read="postgres")
+        except Exception:
+            statements = None
+        if statements is not None:
+            # parse_one would silently keep only the first of several statements.
+            if len(statements) != 1 or statements[0] is None:
+                return sql
+            return statements[0].sql(dialect="postgres", normalize=True)
+    return _SQL_WS_OR_VERBATIM.sub(lambda m: m.group(1) or " ", sql).strip().rstrip(";").rstrip()
+
+
+def _tool_cache_key(mcp_tool_name, tool_args):
+    # Canonicalize only the key; the arguments sent to MCP are left untouched.
+    if mcp_tool_name == SQL_QUERY_TOOL_NAME and isinstance(tool_args.get("sql"), str):
+        tool_args = {**tool_args, "sql": _canonicalize_sql(tool_args["sql"])}
+    return f"{mcp_tool_name}:{_json_dumps_sorted(tool_args)}"
+
+
+def _extract_tool_output_text(tool_response_mcp_sdk):
+    return next(
+        (item.text for item in (getattr(tool_response_mcp_sdk, "content", None) or ())
+         if getattr(item, "type", None) == "text" and hasattr(item, "text")),
+        "Tool execution failed or returned no text.",
+    )
+
+
+async def _call_mcp_tool(session, tool_cache, mcp_tool_name, tool_args, timeout=MCP_TOOL_TIMEOUT_SECONDS):
+    """Call an MCP tool and return its text output, serving repeated calls from tool_cache within the TTL.
+
+    tool_cache maps key -> (stored_at, tool_output_text) and must belong to the chat session that owns
+    `session`: MCP connections are per session, so cached rows must never be shared across sessions.
+    """
+    cache_key = _tool_cache_key(mcp_tool_name, tool_args)
+    cached = tool_cache.get(cache_key)
+    if cached is not None and time.monotonic() - cached[0] < TOOL_CACHE_TTL_SECONDS:
+        logger.debug("Tool cache hit for %s", mcp_tool_name)
+        return cached[1]
+
+    tool_response_mcp_sdk = await asyncio.wait_for(
+        session.call_tool(name=mcp_tool_name, arguments=tool_args), timeout=timeout
+    )
+    logger.debug("Raw response from MCP server: %s", tool_response_mcp_sdk)
+    tool_output_text = _extract_tool_output_text(tool_response_mcp_sdk)
+
+    if tool_response_mcp_sdk and not getattr(tool_response_mcp_sdk, "isError", False):
+        tool_cache.pop(cache_key, None)
+        if len(tool_cache) >= TOOL_CACHE_MAX_ENTRIES:
+            # Entries are re-inserted on refresh, so the first key is the oldest.
+            tool_cache.pop(next(iter(tool_cache)))
+        tool_cache[cache_key] = (time.monotonic(), tool_output_text)
+    return tool_output_text
+
+
+class TokenStreamBuffer:
+    """Batches streamed LLM tokens so the UI gets one websocket frame per flush interval instead of per delta."""
+
+    def __init__(self, stream_token):
+        self._stream_token = stream_token
+        self._chunks = []
+        self._pending = []
+        self._pending_len = 0
+        self._last_flush = time.monotonic()
+
+    async def add(self, token):
+        self._chunks.append(token)
+        self._pending.append(token)
+        self._pending_len += len(token)
+        now = time.monotonic()
+        if self._pending_len >= STREAM_FLUSH_MAX_CHARS or now - self._last_flush >= STREAM_FLUSH_INTERVAL_SECONDS:
+            await self.flush(now)
+
+    async def flush(self, now=None):
+        if self._pending:
+            await self._stream_token("".join(self._pending))
+            self._pending.clear()
+            self._pending_len = 0
+        self._last_flush = time.monotonic() if now is None else now
+
+    @property
+    def text(self):
+        return "".join(self._chunks)
+
+
+class IncrementalJsonParser:
+    """Tracks streamed tool-call arguments and parses them as soon as the top-level object closes."""
+
+    def __init__(self):
+        self._parts = []
+        self._depth = 0
+        self._started = False
+        self._in_string = False
+        self._escape = False
+        self.done = False
+
+    def feed(self, chunk):
+        """Add a chunk; returns the parsed dict once the top-level object is complete, otherwise None."""
+        if self.done or not chunk:
+            return None
+        self._parts.append(chunk)
+        for ch in chunk:
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+                self._started = True
+            elif ch in "}]":
+                self._depth -= 1
+                if self._started and self._depth == 0:
+                    self.done = True
+                    break
+        if not self.done:
+            return None
+        try:
+            parsed = _json_loads("".join(self._parts))
+        except json.JSONDecodeError:
+            # Leave malformed arguments to the post-stream parse, which reports the error.
+            return None
+        return parsed if isinstance(parsed, dict) else None
 
 @cl.on_chat_start
 async def start_chat():
-    print("DEBUG: on_chat_start called")
+    logger.debug("on_chat_start called")
     if not MCP_CLASSES_AVAILABLE:
         await cl.Message(content="Critical Error: MCP ClientSession class not available. Please check imports and dependencies.").send()
     if not azure_client:
         await cl.Message(content="Critical Error: Azure OpenAI client not configured. Please check environment variables.").send()
         
     await cl.Message(content="Hello! I can help you query your PostgreSQL database. What would you like to know?").send()
-    cl.user_session.set("history", [])
-    cl.user_session.set("openai_tools_for_mcp", {})
-    print("DEBUG: Chat session initialized.")
+    cl.user_session.set("history", deque(maxlen=MAX_HISTORY_MESSAGES))
+    cl.user_session.set("active_openai_tools", [])
+    cl.user_session.set("mcp_name_map", {})
+    cl.user_session.set("tool_adapters", {})
+    cl.user_session.set("tools_debug_str", "[]")
+    cl.user_session.set("tool_cache", {})
+    logger.debug("Chat session initialized.")
 
 @cl.on_mcp_connect
 async def on_mcp_connect(connection, session: ClientSession):
     connection_name = getattr(connection, 'name', 'unknown_mcp_server')
-    print(f"DEBUG: on_mcp_connect called for connection: {connection_name}")
+    logger.debug("on_mcp_connect called for connection: %s", connection_name)
 
     if connection_name == POSTGRES_MCP_SERVER_NAME:
-        print(f"DEBUG: ***** SUCCESSFULLY ENTERED on_mcp_connect FOR {POSTGRES_MCP_SERVER_NAME} *****")
+        logger.debug("Entered on_mcp_connect for %s", POSTGRES_MCP_SERVER_NAME)
         await cl.Message(content=f"Chainlit successfully connected to MCP server: '{POSTGRES_MCP_SERVER_NAME}'! Session object: {session}").send()
         # Now, let's try listing tools here and see what happens
         try:
             list_tools_result = await session.list_tools()
-            print(f"DEBUG: list_tools_result for {connection_name} inside specific block: {list_tools_result}")
+            logger.debug("list_tools_result for %s inside specific block: %s", connection_name, list_tools_result)
             if list_tools_result and hasattr(list_tools_result, 'tools') and list_tools_result.tools:
                 tool_names = [t.name for t in list_tools_result.tools]
                 await cl.Message(content=f"Tools found for '{connection_name}': {tool_names}").send()
                  # Try to populate the session tools here directly
-                current_mcp_tools_formatted = cl.user_session.get("openai_tools_for_mcp", {})
                 connection_openai_tools = []
+                name_map = {}
+                tool_adapters = {}
                 for tool_spec in list_tools_result.tools:
                     openai_tool_name = f"{connection_name}__{tool_spec.name.replace('/', '__')}"
+                    name_map[openai_tool_name] = tool_spec.name
+                    adapter = _build_tool_adapter(tool_spec.inputSchema)
+                    if adapter is not None:
+                        tool_adapters[openai_tool_name] = adapter
                     connection_openai_tools.append({
                         "type": "function",
                         "function": {
@@ -79,23 +385,30 @@ async def on_mcp_connect(connection, session: ClientSession):
                             "parameters": tool_spec.inputSchema or {"type": "object", "properties": {}}
                         }
                     })
-                current_mcp_tools_formatted[connection_name] = connection_openai_tools
-                cl.user_session.set("openai_tools_for_mcp", current_mcp_tools_formatted)
-                print(f"DEBUG: Tools for {connection_name} set in session: {connection_openai_tools}")
+                # main() only ever uses the postgres tools, so store them directly rather than per connection.
+                cl.user_session.set("active_openai_tools", connection_openai_tools)
+                cl.user_session.set("mcp_name_map", name_map)
+                cl.user_session.set("tool_adapters", tool_adapters)
+                # A (re)connected server may point at a different database; start with an empty cache.
+                cl.user_session.set("tool_cache", {})
+                if logger.isEnabledFor(logging.DEBUG):
+                    # The tool list is constant for the session, so render it for debug logs once here.
+                    cl.user_session.set("tools_debug_str", _json_dumps_indented(connection_openai_tools))
+                logger.debug("Tools for %s set in session: %s", connection_name, connection_openai_tools)
 
             else:
                 await cl.Message(content=f"No tools returned by list_tools() for '{connection_name}' or result format unexpected.").send()
 
         except Exception as e:
-            print(f"DEBUG: Error calling list_tools for '{connection_name}': {str(e)}")
+            logger.error("Error calling list_tools for '%s': %s", connection_name, e)
             await cl.Message(content=f"Error calling list_tools for '{connection_name}': {str(e)}").send()
     else:
-        print(f"DEBUG: on_mcp_connect called for a different server: {connection_name}")
-        await cl.Message(content=f"Error fetching/processing tools from MCP server '{connection_name}': {str(e)}").send()
+        # Only the postgres server's tools are offered to the model; other connections are left unused.
+        logger.debug("Ignoring tools from MCP server '%s'; only '%s' is used.", connection_name, POSTGRES_MCP_SERVER_NAME)
 
 @cl.on_message
 async def main(message: cl.Message):
-    print(f"DEBUG: on_message received: {message.content}")
+    logger.debug("on_message received: %s", message.content)
     if not MCP_CLASSES_AVAILABLE or ClientSession is None:
         await cl.Message(content="Error: MCP ClientSession class not available. Cannot process message.").send()
         return
@@ -103,208 +416,300 @@ async def main(message: cl.Message):
         await cl.Message(content="Error: Azure OpenAI client not configured. Cannot process message.").send()
         return
 
+    # Checked before anything touches history, so a message that cannot be answered is not recorded.
+    mcp_sessions = cl.context.session.mcp_sessions
+    logger.debug("Available MCP sessions: %s", mcp_sessions.keys() if mcp_sessions else 'None')
+    postgres_mcp_session_tuple = mcp_sessions.get(POSTGRES_MCP_SERVER_NAME) if mcp_sessions else None
+    actual_mcp_session = postgres_mcp_session_tuple[0] if postgres_mcp_session_tuple else None
+    if cl.user_session.get("active_openai_tools") and actual_mcp_session is None:
+        error_msg_no_session = f"Error: Could not find active MCP session for '{POSTGRES_MCP_SERVER_NAME}'."
+        logger.error("%s", error_msg_no_session)
+        await cl.Message(content=error_msg_no_session).send()
+        return
+    logger.debug("Obtained MCP session for '%s'", POSTGRES_MCP_SERVER_NAME)
+
+    # Bounded by the deque's maxlen; when old entries fall off, drop anything left ahead of the
+    # oldest user message so the conversation always starts with a user turn.
     history = cl.user_session.get("history")
-    history.append({"role": "user", "content": message.content})
+    _history_append = history.append
+    _history_append({"role": "user", "content": message.content})
+    while history[0].get("role") != "user":
+        history.popleft()
 
-    messages_for_llm = [
-        {"role": "system", "content": "You are a helpful assistant that can query a PostgreSQL database. When you need to query the database, use the tool provided by the 'postgres' MCP server. The SQL should be valid PostgreSQL."}
-    ]
+    messages_for_llm = [SYSTEM_MESSAGE]
     messages_for_llm.extend(history)
 
-    all_openai_mcp_tools_dict = cl.user_session.get("openai_tools_for_mcp", {})
-    active_openai_tools = all_openai_mcp_tools_dict.get(POSTGRES_MCP_SERVER_NAME, [])
+    active_openai_tools = cl.user_session.get("active_openai_tools") or []
+    name_map = cl.user_session.get("mcp_name_map") or {}
+    tool_adapters = cl.user_session.get("tool_adapters") or {}
+    tool_cache = cl.user_session.get("tool_cache")
+    if tool_cache is None:
+        tool_cache = {}
+        cl.user_session.set("tool_cache", tool_cache)
     # This is the critical point: if active_openai_tools is empty, the LLM won't know about the tools.
-    print(f"DEBUG: Retrieved 'openai_tools_for_mcp' from session for '{POSTGRES_MCP_SERVER_NAME}': {active_openai_tools}")
+    logger.debug("Retrieved 'active_openai_tools' from session for '%s': %s", POSTGRES_MCP_SERVER_NAME, active_openai_tools)
     
-    settings = {
-        "model": azure_deployment_name,
-        "messages": messages_for_llm,
-        "tools": active_openai_tools if active_openai_tools else None,
-        "tool_choice": "auto" if active_openai_tools else None,
-    }
+    # Shared by every completion in this turn; only the messages change between calls.
+    base_kwargs = {"model": azure_deployment_name, "stream": True}
+    if active_openai_tools:
+        base_kwargs["tools"] = active_openai_tools
+        base_kwargs["tool_choice"] = "auto"
+    # Used for the last allowed round so the model has to answer instead of requesting more tools.
+    final_kwargs = {"model": azure_deployment_name, "stream": True}
 
     response_message_content = ""
     
-    cl_msg = cl.Message(content="")
-    await cl_msg.send() 
+    # Created on the first streamed token so no empty message round-trip precedes the LLM call.
+    cl_msg = None
+
+    async def _stream_to_ui(token):
+        nonlocal cl_msg
+        if cl_msg is None:
+            cl_msg = cl.Message(content="")
+            await cl_msg.send()
+        await cl_msg.stream_token(token)
+
+    # MCP calls are started as soon as a tool call's arguments are known, keyed by tool-call index,
+    # so they run while the LLM is still streaming its remaining tokens.
+    arg_parsers = {}
+    pending_tool_tasks: dict[int, asyncio.Task] = {}
+    pending_tool_args = {}
+
+    def _dispatch_tool_call(index, mcp_tool_name, tool_args):
+        logger.debug("Dispatching tool call %s to %s", index, mcp_tool_name)
+        pending_tool_args[index] = tool_args
+        pending_tool_tasks[index] = asyncio.create_task(
+            _call_mcp_tool(actual_mcp_session, tool_cache, mcp_tool_name, tool_args)
+        )
+
+    # Set by _invoke once any call in this turn gets past name/argument checks. It is never reset between
+    # rounds: the follow-up completion is only skipped when no call in the whole turn reached MCP.
+    any_tool_dispatched = False
+
+    async def _invoke(tool_call_index, tool_call):
+        nonlocal any_tool_dispatched
+        openai_tool_name = tool_call["function"]["name"]
+        logger.debug("LLM wants to call OpenAI tool: %s", openai_tool_name)
+
+        mcp_tool_name_actual = name_map.get(openai_tool_name)
+        if mcp_tool_name_actual is None:
+            error_msg_tool_format = f"Error: Tool name '{openai_tool_name}' not in expected format for server '{POSTGRES_MCP_SERVER_NAME}'."
+            logger.debug("%s", error_msg_tool_format)
+            await _stream_to_ui(error_msg_tool_format + "\n")
+            return _tool_msg(tool_call["id"], openai_tool_name, error_msg_tool_format)
+
+        pending_task = pending_tool_tasks.pop(tool_call_index, None)
+        tool_arguments_str = tool_call["function"].get("arguments", "{}")
+        try:
+            if pending_task is not None:
+                tool_args = pending_tool_args[tool_call_index]
+            else:
+                tool_args = _parse_tool_args(tool_adapters.get(openai_tool_name), tool_arguments_str)
+            logger.debug("Parsed tool arguments for %s: %s", mcp_tool_name_actual, tool_args)
+        except json.JSONDecodeError as json_err:
+            error_content = f"Error: Could not parse arguments for tool {mcp_tool_name_actual}: {tool_arguments_str}. JSON Error: {json_err}"
+            logger.debug("%s", error_content)
+            await _stream_to_ui(error_content + "\n")
+            return _tool_msg(tool_call["id"], openai_tool_name, f"Error: Invalid JSON arguments for tool {mcp_tool_name_actual}. Arguments: {tool_arguments_str}")
+        except ValidationError as validation_err:
+            error_content = f"Error: Invalid arguments for tool {mcp_tool_name_actual}: {tool_arguments_str}. Validation Error: {validation_err}"
+            logger.debug("%s", error_content)
+            await _stream_to_ui(error_content + "\n")
+            return _tool_msg(tool_call["id"], openai_tool_name, error_content)
+
+        any_tool_dispatched = True
+        await _stream_to_ui(f"Calling MCP tool: `{POSTGRES_MCP_SERVER_NAME}/{mcp_tool_name_actual}` with args: `{tool_args}`\n")
+
+        try:
+            logger.debug("Calling actual_mcp_session.call_tool for %s with args %s", mcp_tool_name_actual, tool_args)
+            if pending_task is not None:
+                tool_output_text = await pending_task
+            else:
+                tool_output_text = await _call_mcp_tool(actual_mcp_session, tool_cache, mcp_tool_name_actual, tool_args)
+            logger.debug("Extracted tool_output_text: %s", tool_output_text)
+
+            await _stream_to_ui(f"Tool response for `{mcp_tool_name_actual}`: \n```json\n{tool_output_text}\n```\n")
+
+            return _tool_msg(tool_call["id"], openai_tool_name, tool_output_text)
+        except asyncio.TimeoutError:
+            error_str = f"Error: MCP tool {mcp_tool_name_actual} timed out after {MCP_TOOL_TIMEOUT_SECONDS:g}s. Try a narrower or cheaper query."
+            logger.warning("%s", error_str)
+            await _stream_to_ui(error_str + "\n")
+            return _tool_msg(tool_call["id"], openai_tool_name, error_str)
+        except Exception as tool_call_e:
+            error_str = f"Error calling MCP tool {mcp_tool_name_actual}: {str(tool_call_e)}"
+            logger.warning("%s", error_str)
+            await _stream_to_ui(error_str + "\n")
+            return _tool_msg(tool_call["id"], openai_tool_name, error_str)
 
     try:
-        print(f"DEBUG: Calling Azure OpenAI with settings: {json.dumps(settings, indent=2)}")
-        stream = await azure_client.chat.completions.create(**settings, stream=True)
-        
-        full_response_text = ""
-        tool_calls_data = [] 
-
-        async for chunk in stream:
-            if chunk.choices and len(chunk.choices) > 0: 
-                delta = chunk.choices[0].delta
-                content_chunk = delta.content
-                tool_call_chunks = delta.tool_calls
-
-                if content_chunk:
-                    full_response_text += content_chunk
-                    await cl_msg.stream_token(content_chunk)
-
-                if tool_call_chunks:
-                    print(f"DEBUG: Received tool_call_chunks: {tool_call_chunks}")
-                    for tc_chunk in tool_call_chunks:
-                        while tc_chunk.index >= len(tool_calls_data):
-                            tool_calls_data.append({})
+        for tool_round in range(MAX_TOOL_ROUNDS + 1):
+            llm_kwargs = base_kwargs if tool_round < MAX_TOOL_ROUNDS else final_kwargs
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "Calling Azure OpenAI (round %s): tools=%s messages=%s",
+                    tool_round,
+                    cl.user_session.get("tools_debug_str") if "tools" in llm_kwargs else "[]",
+                    _json_dumps(messages_for_llm),
+                )
+            stream = await azure_client.chat.completions.create(messages=messages_for_llm, **llm_kwargs)
+            arg_parsers.clear()
+            pending_tool_tasks.clear()
+            pending_tool_args.clear()
+
+            content_buffer = TokenStreamBuffer(_stream_to_ui)
+            tool_calls_data = [] 
+            # Bound once: these are called per delta in the streaming loop below.
+            _tcd_append = tool_calls_data.append
+            tcd_len = 0
+            _buffer_token = content_buffer.add
+            tool_call_deltas_started = False
+
+            async for chunk in stream:
+                if chunk.choices and len(chunk.choices) > 0: 
+                    delta = chunk.choices[0].delta
+                    content_chunk = delta.content
+                    tool_call_chunks = delta.tool_calls
+
+                    if content_chunk:
+                        await _buffer_token(content_chunk)
+
+                    if tool_call_chunks:
+                        if not tool_call_deltas_started:
+                            # No more content deltas may arrive to trigger the time-based flush, so show the
+                            # buffered text now rather than after the whole argument stream.
+                            tool_call_deltas_started = True
+                            await content_buffer.flush()
+                        logger.debug("Received tool_call_chunks: %s", tool_call_chunks)
+                        for tc_chunk in tool_call_chunks:
+                            while tc_chunk.index >= tcd_len:
+                                _tcd_append({})
+                                tcd_len += 1
                         
-                        current_tool_call = tool_calls_data[tc_chunk.index]
+                            current_tool_call = tool_calls_data[tc_chunk.index]
                         
-                        if "id" not in current_tool_call and tc_chunk.id:
-                                current_tool_call["id"] = tc_chunk.id
-                        if "type" not in current_tool_call and tc_chunk.type:
-                                current_tool_call["type"] = tc_chunk.type
-                        elif "type" not in current_tool_call:
-                                current_tool_call["type"] = "function"
+                            if "id" not in current_tool_call and tc_chunk.id:
+                                    current_tool_call["id"] = tc_chunk.id
+                            if "type" not in current_tool_call and tc_chunk.type:
+                                    current_tool_call["type"] = tc_chunk.type
+                            elif "type" not in current_tool_call:
+                                    current_tool_call["type"] = "function"
                         
-                        if "function" not in current_tool_call:
-                                current_tool_call["function"] = {"name": "", "arguments": ""}
+                            if "function" not in current_tool_call:
+                                    current_tool_call["function"] = {"name_parts": [], "args_parts": []}
 
-                        if tc_chunk.id:
-                            current_tool_call["id"] = tc_chunk.id
+                            if tc_chunk.id:
+                                current_tool_call["id"] = tc_chunk.id
 
-                        if tc_chunk.function:
-                            if tc_chunk.function.name:
-                                current_tool_call["function"]["name"] += tc_chunk.function.name
-                            if tc_chunk.function.arguments:
-                                current_tool_call["function"]["arguments"] += tc_chunk.function.arguments
-            else:
-                pass
+                            if tc_chunk.function:
+                                if tc_chunk.function.name:
+                                    current_tool_call["function"]["name_parts"].append(tc_chunk.function.name)
+                                if tc_chunk.function.arguments:
+                                    current_tool_call["function"]["args_parts"].append(tc_chunk.function.arguments)
+                                    parser = arg_parsers.get(tc_chunk.index)
+                                    if parser is None:
+                                        parser = arg_parsers[tc_chunk.index] = IncrementalJsonParser()
+                                    parsed_args = parser.feed(tc_chunk.function.arguments)
+                                    if parsed_args is not None and actual_mcp_session is not None:
+                                        early_openai_tool_name = "".join(current_tool_call["function"]["name_parts"])
+                                        early_mcp_tool_name = name_map.get(early_openai_tool_name)
+                                        if early_mcp_tool_name:
+                                            try:
+                                                parsed_args = _validate_tool_args(tool_adapters.get(early_openai_tool_name), parsed_args)
+                                            except ValidationError:
+                                                pass  # Reported per tool call after the stream.
+                                            else:
+                                                _dispatch_tool_call(tc_chunk.index, early_mcp_tool_name, parsed_args)
+                else:
+                    pass
+
+            await content_buffer.flush()
+            full_response_text = content_buffer.text
+
+            # Deltas are accumulated as lists to avoid quadratic string concatenation; join them once here.
+            for tool_call_index, tool_call in enumerate(tool_calls_data):
+                function_parts = tool_call.get("function")
+                if function_parts is not None:
+                    tool_call["function"] = {
+                        "name": "".join(function_parts["name_parts"]),
+                        "arguments": "".join(function_parts["args_parts"]),
+                    }
+                    # The incremental parser stops at the first complete object; if anything followed it, the
+                    # early call ran with the wrong arguments, so drop it and let _invoke report the full string.
+                    if tool_call_index in pending_tool_tasks:
+                        try:
+                            full_args = _json_loads(tool_call["function"]["arguments"])
+                        except json.JSONDecodeError:
+                            full_args = None
+                        if full_args != pending_tool_args[tool_call_index]:
+                            logger.debug("Arguments for tool call %s changed after early dispatch; cancelling it", tool_call_index)
+                            pending_tool_tasks.pop(tool_call_index).cancel()
+                            del pending_tool_args[tool_call_index]
+                    # Start any call the incremental parser could not dispatch mid-stream before doing UI work.
+                    if actual_mcp_session is not None and tool_call_index not in pending_tool_tasks:
+                        mcp_tool_name = name_map.get(tool_call["function"]["name"])
+                        if mcp_tool_name:
+                            try:
+                                tool_args = _parse_tool_args(
+                                    tool_adapters.get(tool_call["function"]["name"]),
+                                    tool_call["function"]["arguments"] or "{}",
+                                )
+                            except (json.JSONDecodeError, ValidationError):
+                                pass  # Reported per tool call below.
+                            else:
+                                _dispatch_tool_call(tool_call_index, mcp_tool_name, tool_args)
         
-        print(f"DEBUG: LLM initial response text: '{full_response_text}'")
-        print(f"DEBUG: LLM tool_calls_data: {tool_calls_data}")
+            logger.debug("LLM response text (round %s): '%s'", tool_round, full_response_text)
+            logger.debug("LLM tool_calls_data: %s", tool_calls_data)
 
-        if tool_calls_data and any(tc.get("function", {}).get("name") for tc in tool_calls_data):
-            await cl_msg.stream_token("\n\nUsing tool(s)...\n")
-            
-            assistant_message_for_history = {"role": "assistant", "tool_calls": tool_calls_data}
-            if full_response_text:
-                assistant_message_for_history["content"] = full_response_text
-            
-            history.append(assistant_message_for_history)
-            messages_for_llm.append(assistant_message_for_history)
+            if not (tool_calls_data and any(tc.get("function", {}).get("name") for tc in tool_calls_data)):
+                response_message_content = full_response_text
+                logger.debug("Final LLM response (round %s): '%s'", tool_round, response_message_content)
+                break
 
-            mcp_sessions = cl.context.session.mcp_sessions
-            print(f"DEBUG: Available MCP sessions: {mcp_sessions.keys() if mcp_sessions else 'None'}")
-            postgres_mcp_session_tuple = mcp_sessions.get(POSTGRES_MCP_SERVER_NAME) if mcp_sessions else None
-            
-            if not postgres_mcp_session_tuple:
-                error_msg_no_session = f"Error: Could not find active MCP session for '{POSTGRES_MCP_SERVER_NAME}'."
-                print(f"DEBUG: {error_msg_no_session}")
-                await cl_msg.stream_token(error_msg_no_session + "\n")
-                await cl.Message(content=error_msg_no_session).send() 
-                return
+            await _stream_to_ui("\n\nUsing tool(s)...\n")
             
-            actual_mcp_session: ClientSession = postgres_mcp_session_tuple[0]
-            print(f"DEBUG: Obtained MCP session for '{POSTGRES_MCP_SERVER_NAME}'")
-
-            for tool_call in tool_calls_data:
-                if not tool_call.get("function", {}).get("name"):
-                    continue
-
-                openai_tool_name = tool_call["function"]["name"]
-                print(f"DEBUG: LLM wants to call OpenAI tool: {openai_tool_name}")
-                
-                expected_prefix = POSTGRES_MCP_SERVER_NAME + "__"
-                if openai_tool_name.startswith(expected_prefix):
-                    mcp_tool_name_actual = openai_tool_name[len(expected_prefix):].replace("__", "/")
-                else:
-                    error_msg_tool_format = f"Error: Tool name '{openai_tool_name}' not in expected format for server '{POSTGRES_MCP_SERVER_NAME}'."
-                    print(f"DEBUG: {error_msg_tool_format}")
-                    await cl_msg.stream_token(error_msg_tool_format + "\n")
-                    messages_for_llm.append({
-                        "tool_call_id": tool_call["id"], "role": "tool", "name": openai_tool_name,
-                        "content": error_msg_tool_format
-                    })
-                    continue
-                
-                tool_arguments_str = tool_call["function"].get("arguments", "{}")
-                try:
-                    tool_args = json.loads(tool_arguments_str)
-                    print(f"DEBUG: Parsed tool arguments for {mcp_tool_name_actual}: {tool_args}")
-                except json.JSONDecodeError as json_err:
-                    error_content = f"Error: Could not parse arguments for tool {mcp_tool_name_actual}: {tool_arguments_str}. JSON Error: {json_err}"
-                    print(f"DEBUG: {error_content}")
-                    await cl_msg.stream_token(error_content + "\n")
-                    messages_for_llm.append({
-                        "tool_call_id": tool_call["id"], "role": "tool", "name": openai_tool_name,
-                        "content": f"Error: Invalid JSON arguments for tool {mcp_tool_name_actual}. Arguments: {tool_arguments_str}",
-                    })
-                    continue
-
-                await cl_msg.stream_token(f"Calling MCP tool: `{POSTGRES_MCP_SERVER_NAME}/{mcp_tool_name_actual}` with args: `{tool_args}`\n")
-
-                try:
-                    print(f"DEBUG: Calling actual_mcp_session.call_tool for {mcp_tool_name_actual} with args {tool_args}")
-                    tool_response_mcp_sdk = await actual_mcp_session.call_tool(name=mcp_tool_name_actual, arguments=tool_args)
-                    print(f"DEBUG: Raw response from MCP server: {tool_response_mcp_sdk}")
-                    
-                    tool_output_text = "Tool execution failed or returned no text."
-                    if tool_response_mcp_sdk and tool_response_mcp_sdk.content:
-                        for item in tool_response_mcp_sdk.content:
-                            if hasattr(item, 'text') and item.type == "text":
-                                tool_output_text = item.text
-                                break
-                    print(f"DEBUG: Extracted tool_output_text: {tool_output_text}")
-                    
-                    await cl_msg.stream_token(f"Tool response for `{mcp_tool_name_actual}`: \n```json\n{tool_output_text}\n```\n")
-
-                    messages_for_llm.append({
-                        "tool_call_id": tool_call["id"], "role": "tool", "name": openai_tool_name,
-                        "content": tool_output_text,
-                    })
-                except Exception as tool_call_e:
-                    error_str = f"Error calling MCP tool {mcp_tool_name_actual}: {str(tool_call_e)}"
-                    print(f"DEBUG: {error_str}")
-                    await cl_msg.stream_token(error_str + "\n")
-                    messages_for_llm.append({
-                        "tool_call_id": tool_call["id"], "role": "tool", "name": openai_tool_name,
-                        "content": error_str,
-                    })
-            
-            print(f"DEBUG: Calling Azure OpenAI again with tool responses: {json.dumps(messages_for_llm, indent=2)}")
-            stream_after_tool_call = await azure_client.chat.completions.create(
-                model=settings["model"],
-                messages=messages_for_llm,
-                stream=True
-            )
-            final_llm_response_text = ""
-            async for chunk_after_tool in stream_after_tool_call: 
-                if chunk_after_tool.choices and len(chunk_after_tool.choices) > 0: 
-                    content_chunk_after_tool = chunk_after_tool.choices[0].delta.content 
-                    if content_chunk_after_tool:
-                        final_llm_response_text += content_chunk_after_tool
-                        await cl_msg.stream_token(content_chunk_after_tool)
+            assistant_tool_call_message = {"role": "assistant", "tool_calls": tool_calls_data}
+            if full_response_text:
+                assistant_tool_call_message["content"] = full_response_text
+            messages_for_llm.append(assistant_tool_call_message)
             
-            response_message_content = final_llm_response_text
-            print(f"DEBUG: Final LLM response after tool call: '{response_message_content}'")
-        
-        else: 
-            response_message_content = full_response_text
-            print(f"DEBUG: LLM response (no tool call): '{response_message_content}'")
-
-
-        if cl_msg.content != response_message_content and response_message_content:
-             await cl_msg.set_content(response_message_content)
-        elif not cl_msg.content and response_message_content: 
-             await cl_msg.set_content(response_message_content)
-        await cl_msg.update()
+            # All tool calls of a turn share the MCP session; run them concurrently so latency is max() not sum().
+            invoked_tool_calls = [(index, tc) for index, tc in enumerate(tool_calls_data) if tc.get("function", {}).get("name")]
+            tasks = [asyncio.create_task(_invoke(index, tc)) for index, tc in invoked_tool_calls]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for (_, tool_call), result in zip(invoked_tool_calls, results):
+                if isinstance(result, BaseException):
+                    # Every tool_call_id still needs a tool message or the follow-up completion is rejected.
+                    logger.error("Unexpected error invoking tool call %s: %s", tool_call.get('id'), result)
+                    result = _tool_msg(tool_call["id"], tool_call["function"]["name"], f"Error calling MCP tool {tool_call['function']['name']}: {str(result)}")
+                messages_for_llm.append(result)
+
+            if not any_tool_dispatched:
+                # Every call this turn was rejected before reaching MCP; asking the LLM to phrase an apology costs a full round-trip.
+                response_message_content = "I hit an error preparing the database query. Could you rephrase?"
+                await _stream_to_ui(response_message_content)
+                break
+
+
+        # Everything, including the final answer, has already been streamed into cl_msg.
+        if cl_msg is not None:
+            await cl_msg.update()
 
 
     except Exception as e:
-        print(f"DEBUG: Error in main on_message handler: {str(e)}")
+        logger.exception("Error in main on_message handler: %s", e)
+        for pending_task in pending_tool_tasks.values():
+            pending_task.cancel()
         response_message_content = f"An error occurred: {str(e)}"
-        if cl_msg.streaming: 
-            await cl_msg.set_content(response_message_content)
+        if cl_msg is not None and cl_msg.streaming: 
+            await cl_msg.stream_token("\n\n" + response_message_content)
             await cl_msg.update()
         else: 
             await cl.Message(content=response_message_content).send()
 
 
     if response_message_content:
-      history.append({"role": "assistant", "content": response_message_content})
+      _history_append({"role": "assistant", "content": response_message_content})
     cl.user_session.set("history", history)
 
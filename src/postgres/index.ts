@@ -33,10 +33,22 @@ const resourceBaseUrl = new URL(databaseUrl);
 resourceBaseUrl.protocol = "postgres:";
 resourceBaseUrl.password = "";
 
+function positiveIntFromEnv(name: string, fallback: number): number {
+  const value = Number.parseInt(process.env[name] ?? "", 10);
+  return Number.isInteger(value) && value > 0 ? value : fallback;
+}
+
+// One server (and pool) is started per chat session, so total DB connections are sessions x PG_POOL_MAX;
+// point databaseUrl at pgBouncer (transaction pooling) to bound them.
 const pool = new pg.Pool({
   connectionString: databaseUrl,
+  max: positiveIntFromEnv("PG_POOL_MAX", 10),
 });
 
+// Applied per transaction with SET LOCAL rather than as a startup parameter, which pgBouncer rejects.
+// The default must match PG_STATEMENT_TIMEOUT_MS in app.py.
+const statementTimeoutMs = positiveIntFromEnv("PG_STATEMENT_TIMEOUT_MS", 30000);
+
 const SCHEMA_PATH = "schema";
 
 server.setRequestHandler(ListResourcesRequestSchema, async () => {
@@ -113,6 +125,7 @@ server.setRequestHandler(CallToolRequestSchema, async (request) => {
     const client = await pool.connect();
     try {
       await client.query("BEGIN TRANSACTION READ ONLY");
+      await client.query(`SET LOCAL statement_timeout = ${statementTimeoutMs}`);
       const result = await client.query(sql);
       return {
         content: [{ type: "text", text: JSON.stringify(result.rows, null, 2) }],